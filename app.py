@@ -1,15 +1,20 @@
-from flask import Flask, render_template, jsonify, request, send_file
-from flask_socketio import SocketIO, emit
+from flask import Flask, Response, render_template, jsonify, request, send_file
+from flask_sock import Sock
 from flask_cors import CORS
+import asyncio
+import atexit
 import threading
 import time
-import json
 import os
-from datetime import datetime
+import queue
+from collections import OrderedDict, deque
+from hashlib import blake2b
+from itertools import count, islice
 import logging
+import orjson
 
 from audio_manager import AudioManager
-from fingerprint_client import FingerprintClient
+from fingerprint_client import AsyncFingerprintClient, FingerprintClient
 from mute_controller import MuteController
 
 # Configure logging
@@ -19,131 +24,279 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'commute-secret-key'
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+sock = Sock(app)
+
+# Outgoing message queue of every connected WebSocket client, each drained by its own /ws handler
+ws_clients = set()
+ws_lock = threading.Lock()
 
 # Initialize components
 audio_manager = AudioManager()
 fingerprint_client = FingerprintClient()
+# Used by the matchers on match_loop
+async_fingerprint_client = AsyncFingerprintClient()
 mute_controller = MuteController()
 
+class AppState:
+    """Shared application state, slots keep the monitoring loop's attribute reads cheap"""
+    __slots__ = (
+        'status', 'is_running', 'current_mute', 'stats', 'activity_log', 'config',
+        'matching_threshold', 'chunk_duration', 'config_version', 'stop_evt'
+    )
+    
+    def __init__(self):
+        self.status = 'idle'
+        self.is_running = False
+        self.current_mute = None
+        self.stats = {
+            'total_mutes': 0,
+            'total_muted_time': 0,
+            'detection_accuracy': 0,
+            'false_positives': 0
+        }
+        self.activity_log = deque(maxlen=50)
+        self.config = {
+            'audio_device': 'default',
+            'matching_threshold': 0.85,
+            'docker_endpoint': 'http://soundfingerprinting:3340',
+            'database_path': '/data/commercials.db',
+            'latency_target': 3,
+            'enable_telemetry': False,
+            'recording_path': '/recordings',
+            'recording_duration': 15,
+            'chunk_duration': 10  # Capture 10 seconds of audio before querying
+        }
+        # Set by /api/stop to wake the monitoring loop out of any wait
+        self.stop_evt = threading.Event()
+        self.config_version = 0
+        self.cache_config()
+    
+    def cache_config(self):
+        """Flatten the config values read by the monitoring loop into slots"""
+        self.matching_threshold = self.config['matching_threshold']
+        self.chunk_duration = self.config['chunk_duration']
+        self.config_version += 1
+
 # Application state
-app_state = {
-    'status': 'idle',
-    'is_running': False,
-    'current_mute': None,
-    'stats': {
-        'total_mutes': 0,
-        'total_muted_time': 0,
-        'detection_accuracy': 0,
-        'false_positives': 0
-    },
-    'activity_log': [],
-    'config': {
-        'audio_device': 'default',
-        'matching_threshold': 0.85,
-        'docker_endpoint': 'http://soundfingerprinting:3340',
-        'database_path': '/data/commercials.db',
-        'latency_target': 3,
-        'enable_telemetry': False,
-        'recording_path': '/recordings',
-        'recording_duration': 15,
-        'chunk_duration': 10  # Capture 10 seconds of audio before querying
-    }
-}
+state = AppState()
+
+# Serialized /api/status body, reused while the state version is unchanged
+_status_cache = {'ts': 0.0, 'version': -1, 'body': b''}
+_status_version = 0
+
+def invalidate_status():
+    global _status_version
+    _status_version += 1
+
+def json_response(obj):
+    return app.response_class(orjson.dumps(obj), mimetype='application/json')
+
+def broadcast(event, data):
+    """
+    Queue an event for every connected WebSocket client
+    Never blocks the caller, a slow browser only delays its own handler thread
+    """
+    msg = orjson.dumps({'event': event, 'data': data}).decode()
+    with ws_lock:
+        for outbox in ws_clients:
+            outbox.put_nowait(msg)
+
+# Log entries waiting to be pushed to clients by log_flusher
+_pending_logs = queue.SimpleQueue()
+
+# (second, 'HH:MM:SS') of the last formatted log timestamp
+_ts_cache = (0, '')
 
 def add_log(message, log_type='info'):
+    global _ts_cache
+    now = time.time()
+    sec = int(now)
+    if sec != _ts_cache[0]:
+        _ts_cache = (sec, time.strftime('%H:%M:%S', time.localtime(sec)))
     log_entry = {
-        'id': int(time.time() * 1000),
-        'timestamp': datetime.now().strftime('%H:%M:%S'),
+        'id': int(now * 1000),
+        'timestamp': _ts_cache[1],
         'message': message,
         'type': log_type
     }
-    app_state['activity_log'].insert(0, log_entry)
-    app_state['activity_log'] = app_state['activity_log'][:50]
-    socketio.emit('log_update', log_entry)
-    logger.info(f"[{log_type}] {message}")
+    state.activity_log.appendleft(log_entry)
+    invalidate_status()
+    _pending_logs.put_nowait(log_entry)
+    logger.info("[%s] %s", log_type, message)
+
+def log_flusher():
+    """Coalesce queued log entries into one log_batch push every 50ms"""
+    while True:
+        time.sleep(0.05)
+        entries = []
+        try:
+            while True:
+                entries.append(_pending_logs.get_nowait())
+        except queue.Empty:
+            pass
+        
+        if entries:
+            broadcast('log_batch', entries)
+
+# Event loop running fingerprint queries while the monitoring loop keeps capturing
+match_loop = asyncio.new_event_loop()
+# Completed query windows waiting for a matcher, (generation, pcm) oldest first
+_windows = asyncio.Queue(maxsize=2)
+# Query results handed back to the monitoring loop, (generation, result)
+_match_results = queue.SimpleQueue()
+# Windows from an older generation are stale once audio has been muted
+_generations = count()
+MATCH_WORKERS = 2
+
+# LRU of query results keyed by the blake2b digest of the query window, only touched on match_loop
+_match_cache = OrderedDict()
+MATCH_CACHE_SIZE = 256
+
+async def match_window(pcm):
+    """Query the fingerprinting service with in-memory PCM, repeated audio is answered from the cache"""
+    key = blake2b(pcm, digest_size=16).digest()
+    result = _match_cache.get(key)
+    if result is not None:
+        _match_cache.move_to_end(key)
+        return result
+    
+    payload = audio_manager.to_query_wav(pcm)
+    result = await async_fingerprint_client.match_wav(payload)
+    # Don't cache transport failures
+    if result is not None:
+        _match_cache[key] = result
+        if len(_match_cache) > MATCH_CACHE_SIZE:
+            _match_cache.popitem(last=False)
+    return result
+
+def _enqueue_window(item):
+    """Runs on match_loop; when the matchers fall behind the oldest window is dropped"""
+    if _windows.full():
+        _windows.get_nowait()
+        logger.warning("Fingerprint queries falling behind, dropped oldest window")
+    _windows.put_nowait(item)
+
+def _drain_windows():
+    while not _windows.empty():
+        _windows.get_nowait()
+
+async def match_worker():
+    while True:
+        generation, pcm = await _windows.get()
+        try:
+            result = await match_window(pcm)
+        except Exception as e:
+            logger.error("Error matching window: %s", e)
+            result = None
+        _match_results.put((generation, result))
 
 def monitoring_loop():
-    chunk_buffer = []
-    chunk_duration = app_state['config']['chunk_duration']
+    # Bind loop invariants and hot methods to locals
+    capture = audio_manager.capture_chunk
+    read_window = audio_manager.read_window
+    reset_ring = audio_manager.reset_ring
+    stop_wait = state.stop_evt.wait
+    call_soon = match_loop.call_soon_threadsafe
+    results = _match_results
+    rate = audio_manager.rate
+    chunk_size = audio_manager.chunk
+    channels = audio_manager.channels
+    threshold = state.matching_threshold
+    config_version = state.config_version
+    
+    # Whole chunks worth of samples (~10 seconds), capped to the ring buffer size
+    samples_needed = min(
+        int(state.chunk_duration * rate / chunk_size) * chunk_size * channels,
+        audio_manager.ring.size
+    )
+    samples_written = 0
+    generation = next(_generations)
+    reset_ring()
     
-    while app_state['is_running']:
+    while state.is_running:
         try:
-            # Capture audio chunk
-            audio_data = audio_manager.capture_chunk()
+            # Wait for the audio callback to fill the ring buffer
+            n = capture()
             
-            if audio_data is None:
-                time.sleep(0.1)
+            if n is None:
+                stop_wait(0.1)
                 continue
             
-            chunk_buffer.append(audio_data)
+            samples_written += n
             
-            # Calculate if we have enough audio (~10 seconds)
-            samples_needed = int(chunk_duration * audio_manager.rate / audio_manager.chunk)
+            if samples_written >= samples_needed:
+                # Hand a snapshot of the window to the matchers, capture carries on meanwhile
+                window = read_window(audio_manager.tail - samples_needed, samples_needed).copy()
+                call_soon(_enqueue_window, (generation, window))
+                samples_written = 0
             
-            if len(chunk_buffer) >= samples_needed:
-                # Save buffer to temp file for querying
-                temp_file = audio_manager.save_buffer_to_file(
-                    chunk_buffer,
-                    '/tmp/query_chunk.wav'
-                )
+            while not results.empty():
+                result_generation, result = results.get_nowait()
+                if result_generation != generation:
+                    continue
                 
-                if temp_file:
-                    # Query the fingerprinting service
-                    result = fingerprint_client.match_audio(temp_file)
+                if result and result.get('is_match'):
+                    confidence = result.get('confidence', 0)
+                    duration = int(result.get('duration', 30))
+                    track_title = result.get('track_title', 'Unknown Commercial')
                     
-                    if result and result.get('is_match'):
-                        confidence = result.get('confidence', 0)
-                        duration = int(result.get('duration', 30))
-                        track_title = result.get('track_title', 'Unknown Commercial')
-                        
-                        if confidence >= app_state['config']['matching_threshold']:
-                            handle_commercial_detected(confidence, duration, track_title)
-                            time.sleep(duration)
+                    if state.config_version != config_version:
+                        threshold = state.matching_threshold
+                        config_version = state.config_version
+                    
+                    if confidence >= threshold:
+                        handle_commercial_detected(confidence, duration, track_title)
+                        # Stop cuts the mute short and restores audio itself
+                        if not stop_wait(duration):
                             handle_commercial_ended(duration)
-                
-                # Clear buffer and continue
-                chunk_buffer = []
-            
-            time.sleep(0.1)
+                        
+                        # Windows queued before the mute ended are stale, start fresh
+                        generation = next(_generations)
+                        call_soon(_drain_windows)
+                        samples_written = 0
+                        reset_ring()
             
         except Exception as e:
-            logger.error(f"Error in monitoring loop: {e}")
+            logger.error("Error in monitoring loop: %s", e)
             add_log(f"Error in monitoring: {str(e)}", 'error')
-            time.sleep(1)
+            stop_wait(1)
+    
+    call_soon(_drain_windows)
 
 def handle_commercial_detected(confidence, duration, track_title='Unknown'):
-    app_state['status'] = 'muted'
-    app_state['current_mute'] = {
+    state.status = 'muted'
+    state.current_mute = {
         'start': time.time(),
         'duration': duration,
         'title': track_title
     }
+    invalidate_status()
     
     mute_controller.mute()
     add_log(f"Commercial detected: '{track_title}' (confidence: {confidence:.2f}) - Muted", 'mute')
-    socketio.emit('status_update', {
+    broadcast('status_update', {
         'status': 'muted',
-        'current_mute': app_state['current_mute']
+        'current_mute': state.current_mute
     })
 
 def handle_commercial_ended(duration):
-    app_state['status'] = 'listening'
-    app_state['current_mute'] = None
+    state.status = 'listening'
+    state.current_mute = None
     
     mute_controller.unmute()
     
     # Update stats
-    app_state['stats']['total_mutes'] += 1
-    app_state['stats']['total_muted_time'] += duration
-    app_state['stats']['detection_accuracy'] = min(95, app_state['stats']['detection_accuracy'] + 0.5)
+    state.stats['total_mutes'] += 1
+    state.stats['total_muted_time'] += duration
+    state.stats['detection_accuracy'] = min(95, state.stats['detection_accuracy'] + 0.5)
+    invalidate_status()
     
     add_log(f"Commercial ended - Unmuted (duration: {duration}s)", 'unmute')
-    socketio.emit('status_update', {
+    broadcast('status_update', {
         'status': 'listening',
         'current_mute': None
     })
-    socketio.emit('stats_update', app_state['stats'])
+    broadcast('stats_update', state.stats)
 
 @app.route('/')
 def index():
@@ -151,26 +304,37 @@ def index():
 
 @app.route('/api/status')
 def get_status():
-    return jsonify({
-        'status': app_state['status'],
-        'is_running': app_state['is_running'],
-        'current_mute': app_state['current_mute'],
-        'stats': app_state['stats'],
-        'activity_log': app_state['activity_log'][:20],
-        'config': app_state['config']
+    now = time.monotonic()
+    version = _status_version
+    if _status_cache['version'] == version and now - _status_cache['ts'] < 0.1:
+        return Response(_status_cache['body'], mimetype='application/json')
+    
+    body = orjson.dumps({
+        'status': state.status,
+        'is_running': state.is_running,
+        'current_mute': state.current_mute,
+        'stats': state.stats,
+        'activity_log': list(islice(state.activity_log, 20)),
+        'config': state.config
     })
+    _status_cache.update(ts=now, version=version, body=body)
+    return Response(body, mimetype='application/json')
 
 @app.route('/api/start', methods=['POST'])
 def start_monitoring():
-    if not app_state['is_running']:
-        app_state['is_running'] = True
-        app_state['status'] = 'listening'
+    if not state.is_running:
+        state.is_running = True
+        state.status = 'listening'
+        state.cache_config()
+        state.stop_evt.clear()
+        invalidate_status()
         
         # Initialize audio
-        success = audio_manager.start(app_state['config']['audio_device'])
+        success = audio_manager.start(state.config['audio_device'])
         if not success:
-            app_state['is_running'] = False
-            app_state['status'] = 'idle'
+            state.is_running = False
+            state.status = 'idle'
+            invalidate_status()
             return jsonify({'success': False, 'error': 'Failed to initialize audio'}), 500
         
         # Start monitoring thread
@@ -178,40 +342,42 @@ def start_monitoring():
         thread.start()
         
         add_log('System started - Monitoring audio for commercials', 'info')
-        return jsonify({'success': True, 'status': app_state['status']})
+        return jsonify({'success': True, 'status': state.status})
     
     return jsonify({'success': False, 'error': 'Already running'})
 
 @app.route('/api/stop', methods=['POST'])
 def stop_monitoring():
-    if app_state['is_running']:
-        app_state['is_running'] = False
-        app_state['status'] = 'idle'
-        app_state['current_mute'] = None
+    if state.is_running:
+        state.is_running = False
+        state.status = 'idle'
+        state.current_mute = None
+        state.stop_evt.set()
+        invalidate_status()
         
         audio_manager.stop()
         mute_controller.unmute()
         
         add_log('System stopped', 'info')
-        return jsonify({'success': True, 'status': app_state['status']})
+        return jsonify({'success': True, 'status': state.status})
     
     return jsonify({'success': False, 'error': 'Not running'})
 
 @app.route('/api/record', methods=['POST'])
 def record_audio():
     try:
-        duration = app_state['config']['recording_duration']
+        duration = state.config['recording_duration']
         add_log(f'Recording audio for {duration} seconds...', 'info')
         
         # Record audio in background thread
         def record():
             filename = audio_manager.record_to_file(
                 duration=duration,
-                output_path=app_state['config']['recording_path']
+                output_path=state.config['recording_path']
             )
             if filename:
                 add_log(f'Audio saved to {filename}', 'success')
-                socketio.emit('recording_complete', {'filename': filename})
+                broadcast('recording_complete', {'filename': filename})
             else:
                 add_log('Recording failed', 'error')
         
@@ -226,11 +392,12 @@ def record_audio():
 def handle_config():
     if request.method == 'POST':
         new_config = request.json
-        app_state['config'].update(new_config)
+        state.config.update(new_config)
+        state.cache_config()
         add_log('Configuration updated', 'success')
-        return jsonify({'success': True, 'config': app_state['config']})
+        return json_response({'success': True, 'config': state.config})
     
-    return jsonify(app_state['config'])
+    return json_response(state.config)
 
 @app.route('/api/test-docker', methods=['POST'])
 def test_docker():
@@ -239,7 +406,7 @@ def test_docker():
         result = fingerprint_client.test_connection()
         
         if result:
-            add_log(f"Connected to {app_state['config']['docker_endpoint']} - API OK", 'success')
+            add_log(f"Connected to {state.config['docker_endpoint']} - API OK", 'success')
             return jsonify({'success': True, 'message': 'Connection successful'})
         else:
             add_log('Connection failed - Check Docker container is running', 'error')
@@ -250,8 +417,8 @@ def test_docker():
 
 @app.route('/api/clear-data', methods=['POST'])
 def clear_data():
-    app_state['activity_log'] = []
-    app_state['stats'] = {
+    state.activity_log.clear()
+    state.stats = {
         'total_mutes': 0,
         'total_muted_time': 0,
         'detection_accuracy': 0,
@@ -283,6 +450,9 @@ def add_commercial():
         )
         
         if success:
+            # New fingerprint may change the answer for previously seen audio.
+            # The cache belongs to match_loop, clear it there rather than on this request thread
+            match_loop.call_soon_threadsafe(_match_cache.clear)
             add_log(f'Successfully added commercial: {title}', 'success')
             return jsonify({'success': True, 'track_id': track_id})
         else:
@@ -293,14 +463,52 @@ def add_commercial():
         add_log(f'Error adding commercial: {str(e)}', 'error')
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@socketio.on('connect')
-def handle_connect():
-    emit('status_update', {
-        'status': app_state['status'],
-        'is_running': app_state['is_running']
-    })
+threading.Thread(target=log_flusher, daemon=True).start()
+for _ in range(MATCH_WORKERS):
+    match_loop.create_task(match_worker())
+threading.Thread(target=match_loop.run_forever, daemon=True).start()
+
+def _close_async_client():
+    """Close the matchers' aiohttp session on match_loop before the interpreter exits"""
+    try:
+        asyncio.run_coroutine_threadsafe(async_fingerprint_client.aclose(), match_loop).result(timeout=5)
+    except Exception as e:
+        logger.warning("Failed to close fingerprint client session: %s", e)
+
+atexit.register(_close_async_client)
+
+@sock.route('/ws')
+def websocket(ws):
+    outbox = queue.SimpleQueue()
+    outbox.put_nowait(orjson.dumps({
+        'event': 'status_update',
+        'data': {
+            'status': state.status,
+            'is_running': state.is_running
+        }
+    }).decode())
+    with ws_lock:
+        ws_clients.add(outbox)
+    
+    try:
+        # This thread does all the sending for its client, so frames never interleave
+        # and go out in broadcast order. The client only listens, receive() just
+        # paces the loop and raises once the connection closes
+        while True:
+            try:
+                while True:
+                    ws.send(outbox.get_nowait())
+            except queue.Empty:
+                pass
+            ws.receive(timeout=0.05)
+    except Exception:
+        pass
+    finally:
+        with ws_lock:
+            ws_clients.discard(outbox)
 
 if __name__ == '__main__':
+    # Development server only, production runs under gunicorn via wsgi.py
     os.makedirs('/recordings', exist_ok=True)
     os.makedirs('/data', exist_ok=True)
-    socketio.run(app, host='0.0.0.0', port=8080, debug=False, allow_unsafe_werkzeug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=8080, debug=False, threaded=True)
\ No newline at end of file
@@ -1,12 +1,42 @@
 import pyaudio
-import wave
+import struct
+import threading
+import time
 import numpy as np
 from datetime import datetime
 import os
 import logging
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
 logger = logging.getLogger(__name__)
 
+WAV_HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')
+
+def make_wav_header(rate, channels, bits, data_len):
+    """44-byte header of a PCM WAV file holding data_len bytes of audio"""
+    block = channels * bits // 8
+    return WAV_HEADER.pack(
+        b'RIFF', 36 + data_len, b'WAVE',
+        b'fmt ', 16, 1, channels, rate, rate * block, block, bits,
+        b'data', data_len
+    )
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def mix_and_decimate(src, out, decim, channels):
+        """Fused mono mix + box-filter decimation of interleaved int16 audio"""
+        step = decim * channels
+        for i in prange(out.shape[0]):
+            s = 0
+            base = i * step
+            for k in range(step):
+                s += src[base + k]
+            out[i] = s // step
+
 class AudioManager:
     def __init__(self):
         self.pyaudio = None
@@ -15,11 +45,34 @@ class AudioManager:
         self.channels = 2
         self.rate = 44100
         self.chunk = 1024
+        # Emy fingerprints 5512Hz mono, queries are converted before upload.
+        # 8:1 decimation of 44.1kHz is really 5512.5Hz; a WAV header only holds an integer
+        # rate, so it says 5512 (a 0.01% pitch difference fingerprinting doesn't notice)
+        self.query_rate = 5512
+        self._decim = self.rate // self.query_rate
+        self._query_buf = np.empty(0, dtype=np.int16)
+        # Header for the (fixed size) query windows, rebuilt only if the window size changes
+        self._query_hdr = make_wav_header(self.query_rate, 1, 16, 0)
+        self._query_hdr_len = 0
         self.is_active = False
+        # Preallocated capture ring (power of 2, ~47 seconds of stereo audio).
+        # Single producer (PortAudio callback) advances head, single consumer advances tail.
+        self.ring = np.empty(1 << 22, dtype=np.int16)
+        self._mask = self.ring.size - 1
+        self._ring_bytes = memoryview(self.ring).cast('B')
+        self.head = 0
+        self.tail = 0
+        self._data_event = threading.Event()
         
+    def _get_pyaudio(self):
+        """Shared PortAudio instance, initialised once and released in stop()"""
+        if self.pyaudio is None:
+            self.pyaudio = pyaudio.PyAudio()
+        return self.pyaudio
+    
     def start(self, device_name='default'):
         try:
-            self.pyaudio = pyaudio.PyAudio()
+            self._get_pyaudio()
             
             # Find device index
             device_index = None
@@ -35,61 +88,185 @@ class AudioManager:
             if device_index is None:
                 device_index = self.pyaudio.get_default_input_device_info()['index']
             
-            # Open stream
+            if njit is not None:
+                # Compile (or load the cached) kernel before the first query window,
+                # and before the stream opens so a failure here can't leave it running
+                mix_and_decimate(np.zeros(self._decim * self.channels, dtype=np.int16),
+                                 np.empty(1, dtype=np.int16), self._decim, self.channels)
+            
+            self.head = 0
+            self.tail = 0
+            self._data_event.clear()
+            
+            # Open stream in callback mode, PortAudio pushes chunks into the ring
             self.stream = self.pyaudio.open(
                 format=self.format,
                 channels=self.channels,
                 rate=self.rate,
                 input=True,
                 input_device_index=device_index,
-                frames_per_buffer=self.chunk
+                frames_per_buffer=self.chunk,
+                stream_callback=self._cb
             )
             
             self.is_active = True
-            logger.info(f"Audio stream started on device {device_index}")
+            logger.info("Audio stream started on device %s", device_index)
             return True
             
         except Exception as e:
-            logger.error(f"Failed to start audio: {e}")
+            logger.error("Failed to start audio: %s", e)
             return False
     
     def stop(self):
         if self.stream:
             self.stream.stop_stream()
             self.stream.close()
+            self.stream = None
         if self.pyaudio:
             self.pyaudio.terminate()
+            self.pyaudio = None
         self.is_active = False
+        self._data_event.set()
         logger.info("Audio stream stopped")
     
-    def capture_chunk(self):
+    def _cb(self, in_data, frame_count, time_info, status):
+        """PortAudio stream callback, copies the chunk into the ring and publishes it"""
+        # Raw byte copy through a memoryview, no per-chunk ndarray
+        nbytes = len(in_data)
+        off = (self.head & self._mask) * 2
+        end = off + nbytes
+        if end <= self._ring_bytes.nbytes:
+            self._ring_bytes[off:end] = in_data
+        else:
+            split = self._ring_bytes.nbytes - off
+            self._ring_bytes[off:] = in_data[:split]
+            self._ring_bytes[:nbytes - split] = in_data[split:]
+        self.head += nbytes // 2
+        self._data_event.set()
+        return (None, pyaudio.paContinue)
+    
+    def capture_chunk(self, timeout=1.0):
+        """Wait for new audio in the ring buffer, returns the number of samples available"""
         if not self.is_active or not self.stream:
             return None
         
-        try:
-            data = self.stream.read(self.chunk, exception_on_overflow=False)
-            audio_array = np.frombuffer(data, dtype=np.int16)
-            return audio_array
-        except Exception as e:
-            logger.error(f"Error capturing audio: {e}")
-            return None
+        if not self._data_event.wait(timeout):
+            return 0
+        self._data_event.clear()
+        
+        head = self.head
+        n = head - self.tail
+        if n > self.ring.size:
+            logger.warning("Audio ring overrun, %d samples dropped", n - self.ring.size)
+        self.tail = head
+        return n
     
-    def save_buffer_to_file(self, buffer, filename):
-        """Save audio buffer to WAV file"""
-        try:
-            audio_data = np.concatenate(buffer)
+    def reset_ring(self):
+        """Discard any audio that has not been consumed yet"""
+        self.tail = self.head
+        self._data_event.clear()
+    
+    def ring_slices(self, start, length):
+        """Views over a region of the ring buffer (absolute sample positions), split at the wrap point"""
+        idx = start & self._mask
+        end = idx + length
+        if end <= self.ring.size:
+            return [self.ring[idx:end]]
+        return [self.ring[idx:], self.ring[:end - self.ring.size]]
+    
+    def read_window(self, start, length):
+        """Region of the ring buffer as one array, a view unless it wraps"""
+        parts = self.ring_slices(start, length)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+    
+    def to_mono_5512(self, samples):
+        """
+        Mix interleaved int16 audio down to mono at the fingerprinting rate
+        Both paths are the same box filter and give identical samples (and match cache keys)
+        With Numba the result lives in a reused buffer, valid until the next call
+        """
+        step = self._decim * self.channels
+        n = samples.size // step
+        if njit is not None:
+            if self._query_buf.size != n:
+                self._query_buf = np.empty(n, dtype=np.int16)
+            mix_and_decimate(samples, self._query_buf, self._decim, self.channels)
+            return self._query_buf
+        
+        # Same floor division of the block sums as the kernel
+        blocks = samples[:n * step].reshape(n, step)
+        return (blocks.sum(axis=1, dtype=np.int64) // step).astype(np.int16)
+    
+    def to_query_wav(self, samples):
+        """Complete WAV payload of a query window, mono at the fingerprinting rate"""
+        query = self.to_mono_5512(samples)
+        if self._query_hdr_len != query.nbytes:
+            self._query_hdr = make_wav_header(self.query_rate, 1, 16, query.nbytes)
+            self._query_hdr_len = query.nbytes
+        return self._query_hdr + memoryview(query)
+    
+    def _write_fully(self, fd, mv):
+        """os.write until everything is written, retrying on EINTR"""
+        off = 0
+        while off < len(mv):
+            try:
+                off += os.write(fd, mv[off:])
+            except InterruptedError:
+                continue
+    
+    def _record_from_ring(self, buf, samples):
+        """
+        Fill buf with the next samples captured by the running monitoring stream
+        Copied out in pieces as they arrive, so the recording can be longer than the ring
+        """
+        per_second = self.rate * self.channels
+        start = self.head
+        got = 0
+        off = 44
+        while got < samples:
+            if not self.is_active:
+                logger.error("Audio stream stopped during recording")
+                return None
             
-            wf = wave.open(filename, 'wb')
-            wf.setnchannels(self.channels)
-            wf.setsampwidth(2)  # 16-bit
-            wf.setframerate(self.rate)
-            wf.writeframes(audio_data.tobytes())
-            wf.close()
+            # Wait for at most a second (or a quarter ring) of new audio, well before it is overwritten
+            time.sleep(min(samples - got, per_second, self.ring.size // 4) / per_second + 0.01)
+            pos = start + got
+            lag = self.head - pos
+            if lag > self.ring.size:
+                logger.error("Recording fell behind the capture ring buffer")
+                return None
             
-            return filename
-        except Exception as e:
-            logger.error(f"Failed to save buffer: {e}")
-            return None
+            n = min(lag, samples - got)
+            for part in self.ring_slices(pos, n):
+                np.frombuffer(buf, dtype=np.int16, count=part.size, offset=off)[:] = part
+                off += part.nbytes
+            got += n
+        return off
+    
+    def _record_from_stream(self, buf):
+        """Fill buf from a short-lived blocking stream on the shared PortAudio instance"""
+        stream = self._get_pyaudio().open(
+            format=self.format,
+            channels=self.channels,
+            rate=self.rate,
+            input=True,
+            frames_per_buffer=self.chunk
+        )
+        
+        mv = memoryview(buf)
+        off = 44
+        try:
+            while off < len(buf):
+                data = stream.read(self.chunk, exception_on_overflow=False)
+                n = min(len(data), len(buf) - off)
+                mv[off:off + n] = data[:n]
+                off += n
+        finally:
+            stream.stop_stream()
+            stream.close()
+        return off
     
     def record_to_file(self, duration=15, output_path='/recordings'):
         os.makedirs(output_path, exist_ok=True)
@@ -97,38 +274,30 @@ class AudioManager:
         filename = os.path.join(output_path, f'recording_{timestamp}.wav')
         
         try:
-            # Temporarily create recording stream
-            p = pyaudio.PyAudio()
-            stream = p.open(
-                format=self.format,
-                channels=self.channels,
-                rate=self.rate,
-                input=True,
-                frames_per_buffer=self.chunk
-            )
-            
-            logger.info(f"Recording {duration} seconds of audio...")
-            frames = []
+            logger.info("Recording %s seconds of audio...", duration)
+            # Leave room for the 44-byte WAV header so the file goes out in one write
+            samples = int(self.rate / self.chunk * duration) * self.chunk * self.channels
+            buf = bytearray(44 + samples * 2)
             
-            for _ in range(0, int(self.rate / self.chunk * duration)):
-                data = stream.read(self.chunk, exception_on_overflow=False)
-                frames.append(data)
-            
-            stream.stop_stream()
-            stream.close()
-            p.terminate()
+            if self.is_active:
+                off = self._record_from_ring(buf, samples)
+            else:
+                off = self._record_from_stream(buf)
+            if off is None:
+                return None
             
             # Save to WAV file
-            wf = wave.open(filename, 'wb')
-            wf.setnchannels(self.channels)
-            wf.setsampwidth(p.get_sample_size(self.format))
-            wf.setframerate(self.rate)
-            wf.writeframes(b''.join(frames))
-            wf.close()
+            data_len = off - 44
+            buf[:44] = make_wav_header(self.rate, self.channels, 16, data_len)
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                self._write_fully(fd, memoryview(buf)[:off])
+            finally:
+                os.close(fd)
             
-            logger.info(f"Recording saved to {filename}")
+            logger.info("Recording saved to %s", filename)
             return filename
             
         except Exception as e:
-            logger.error(f"Recording failed: {e}")
+            logger.error("Recording failed: %s", e)
             return None
\ No newline at end of file
@@ -1,90 +1,232 @@
 import requests
-import json
-import base64
+import aiohttp
+import aiofiles
+import orjson
 import os
+import mmap
+import time
+import threading
 import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
+API_SUFFIX = '/api/v1.1'
+
+def _api_base(endpoint):
+    """Endpoint with the API version path, whether or not it was already given"""
+    endpoint = endpoint.rstrip('/')
+    if endpoint.endswith(API_SUFFIX):
+        endpoint = endpoint[:-len(API_SUFFIX)]
+    return endpoint.rstrip('/') + API_SUFFIX
+
+def _summarize_matches(results):
+    """Reduce Emy query results to a simplified match result"""
+    # Only repr the (large) result when someone is listening
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Query response: %s", results)
+    
+    # Check if we have matches
+    if results and len(results) > 0:
+        # Return simplified match result
+        best_match = results[0]
+        audio_coverage = best_match.get('audio', {}).get('coverage', {})
+        
+        return {
+            'is_match': True,
+            'confidence': audio_coverage.get('trackCoverage', 0),
+            'track_id': best_match.get('track', {}).get('id'),
+            'track_title': best_match.get('track', {}).get('title'),
+            'duration': audio_coverage.get('trackCoverageLength', 30)
+        }
+    else:
+        return {'is_match': False}
+
 class FingerprintClient:
     def __init__(self):
         # Emy Docker container runs on port 3340
-        self.endpoint = 'http://soundfingerprinting:3340/api/v1.1'
+        self.set_endpoint('http://soundfingerprinting:3340')
         self.timeout = 10
         # Default credentials for Community Edition
         self.auth = HTTPBasicAuth('Admin', '')
+        # Keep-alive pooled connections shared by every call
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        self.session.headers.update({'Accept': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=20,
+                              max_retries=Retry(total=2, backoff_factor=0.2))
+        # Same pooling and retries whichever scheme set_endpoint is given
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # LRU of match_audio results keyed by the blake2b digest of the uploaded file.
+        # Only for callers querying files; the live monitoring path queries in-memory
+        # windows through AsyncFingerprintClient and caches those in app.py
+        self._cache = OrderedDict()
+        self._cache_max = 256
+        # match_audio_many workers share the cache
+        self._cache_lock = threading.Lock()
+        # Concurrent queries and uploads share the session's pooled connections
+        self._pool = ThreadPoolExecutor(max_workers=8)
+        # (fetched_at, tracks) from the last GET /tracks
+        self._tracks_cache = None
+        self._tracks_ttl = 30
+        # Form fields shared by every add_fingerprint upload, per-track values are patched in
+        self._add_data_template = {
+            'track.artist': 'Unknown',
+            'track.mediaType': 'Audio',
+            'insertOriginalPoints': 'true'
+        }
+    
+    def close(self):
+        """Release the pooled connections"""
+        self._pool.shutdown(wait=False)
+        self.session.close()
     
     def set_endpoint(self, endpoint):
         # Remove /api/v1.1 if provided, we'll add it
-        self.endpoint = endpoint.rstrip('/api/v1.1').rstrip('/')
-        self.endpoint = f"{self.endpoint}/api/v1.1"
+        self.endpoint = _api_base(endpoint)
+        self._url_tracks = self.endpoint + '/tracks'
+        self._url_query = self.endpoint + '/tracks/query'
+        self._url_matches = self.endpoint + '/matches'
+        self.invalidate_tracks_cache()
+    
+    def invalidate_tracks_cache(self):
+        """Drop the cached /tracks listing"""
+        self._tracks_cache = None
+    
+    def _cached_tracks(self):
+        """The /tracks listing if it was fetched within the TTL, otherwise None"""
+        cached = self._tracks_cache
+        if cached is not None and time.monotonic() - cached[0] < self._tracks_ttl:
+            return cached[1]
+        return None
     
     def test_connection(self):
-        """Test connection by fetching tracks"""
+        """Test connection by fetching tracks, a recent successful fetch counts as connected"""
+        if self._cached_tracks() is not None:
+            return True
         try:
-            response = requests.get(
-                f"{self.endpoint}/tracks",
-                auth=self.auth,
-                headers={'Accept': 'application/json'},
+            response = self.session.get(
+                self._url_tracks,
                 timeout=self.timeout
             )
-            logger.info(f"Connection test response: {response.status_code}")
-            return response.status_code == 200
+            logger.info("Connection test response: %s", response.status_code)
+            if response.status_code != 200:
+                return False
+            self._tracks_cache = (time.monotonic(), orjson.loads(response.content))
+            return True
         except Exception as e:
-            logger.error(f"Connection test failed: {e}")
+            logger.error("Connection test failed: %s", e)
             return False
     
     def match_audio(self, audio_file_path):
         """
         Query Emy with an audio file to find matches
-        Uses the GET /tracks endpoint with file parameter
+        Files already queried are answered from the client's cache without a round-trip
+        (match_wav and AsyncFingerprintClient are not cached here)
         """
         try:
             if not os.path.exists(audio_file_path):
-                logger.error(f"Audio file not found: {audio_file_path}")
+                logger.error("Audio file not found: %s", audio_file_path)
                 return None
             
-            # Use multipart form to upload file for querying
             with open(audio_file_path, 'rb') as f:
-                files = {'file': f}
+                # Nothing to query, and an empty file can't be mapped
+                if os.fstat(f.fileno()).st_size == 0:
+                    logger.error("Audio file is empty: %s", audio_file_path)
+                    return None
                 
-                response = requests.post(
-                    f"{self.endpoint}/tracks/query",
-                    auth=self.auth,
-                    files=files,
-                    headers={'Accept': 'application/json'},
-                    timeout=self.timeout
-                )
+                # Hash through a read-only mapping, the file is never copied into Python
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    key = blake2b(mm, digest_size=16).digest()
+                with self._cache_lock:
+                    result = self._cache.get(key)
+                    if result is not None:
+                        self._cache.move_to_end(key)
+                        return result
+                
+                result = self._match_audio_uncached(key, f)
             
-            if response.status_code == 200:
-                results = response.json()
-                logger.info(f"Query response: {results}")
+            # Don't cache transport failures
+            if result is not None:
+                with self._cache_lock:
+                    self._cache[key] = result
+                    if len(self._cache) > self._cache_max:
+                        self._cache.popitem(last=False)
+            return result
+            
+        except Exception as e:
+            logger.error("Error querying audio: %s", e)
+            return None
+    
+    def match_audio_many(self, audio_file_paths):
+        """
+        Query several audio files concurrently, results are in the same order as the paths
+        For library callers, the monitoring loop queries through AsyncFingerprintClient
+        """
+        return list(self._pool.map(self.match_audio, audio_file_paths))
+    
+    def _match_audio_uncached(self, blob_hash, blob):
+        """Upload the audio (an open file) to Emy, bypassing the cache"""
+        try:
+            # Streamed from the file, the multipart body is never buffered. It has to be
+            # the file object: the encoder only tracks the remaining length of objects
+            # with a fileno, a raw mmap never reaches EOF and the upload never ends
+            encoder = MultipartEncoder(fields={'file': ('query.wav', blob, 'audio/wav')})
+            response = self.session.post(
+                self._url_query,
+                data=encoder,
+                headers={'Content-Type': encoder.content_type},
+                timeout=self.timeout
+            )
+            
+            return self._parse_query_response(response)
                 
-                # Check if we have matches
-                if results and len(results) > 0:
-                    # Return simplified match result
-                    best_match = results[0]
-                    audio_coverage = best_match.get('audio', {}).get('coverage', {})
-                    
-                    return {
-                        'is_match': True,
-                        'confidence': audio_coverage.get('trackCoverage', 0),
-                        'track_id': best_match.get('track', {}).get('id'),
-                        'track_title': best_match.get('track', {}).get('title'),
-                        'duration': audio_coverage.get('trackCoverageLength', 30)
-                    }
-                else:
-                    return {'is_match': False}
-            else:
-                logger.warning(f"Query failed: {response.status_code} - {response.text}")
-                return None
+        except requests.exceptions.Timeout:
+            logger.warning("Fingerprint query timed out (%s)", blob_hash.hex())
+            return None
+        except Exception as e:
+            logger.error("Error querying audio: %s", e)
+            return None
+    
+    def clear_cache(self):
+        """Forget cached query results, they may be stale once tracks change"""
+        with self._cache_lock:
+            self._cache.clear()
+    
+    def match_wav(self, payload):
+        """
+        Query Emy with an in-memory WAV file
+        Nothing touches disk, the payload is uploaded as is
+        """
+        try:
+            response = self.session.post(
+                self._url_query,
+                files={'file': ('query.wav', payload, 'audio/wav')},
+                timeout=self.timeout
+            )
+            
+            return self._parse_query_response(response)
                 
         except requests.exceptions.Timeout:
             logger.warning("Fingerprint query timed out")
             return None
         except Exception as e:
-            logger.error(f"Error querying audio: {e}")
+            logger.error("Error querying audio: %s", e)
+            return None
+    
+    def _parse_query_response(self, response):
+        """Reduce an Emy query response to a simplified match result"""
+        if response.status_code == 200:
+            return _summarize_matches(orjson.loads(response.content))
+        else:
+            logger.warning("Query failed: %s - %s", response.status_code, response.text)
             return None
     
     def add_fingerprint(self, audio_file, track_id, title, artist='Unknown', media_type='Audio'):
@@ -94,67 +236,143 @@ class FingerprintClient:
         """
         try:
             if not os.path.exists(audio_file):
-                logger.error(f"Audio file not found: {audio_file}")
+                logger.error("Audio file not found: %s", audio_file)
                 return False
             
-            # Prepare track metadata
-            track_data = {
-                'id': track_id,
-                'title': title,
-                'artist': artist,
-                'mediaType': media_type
-            }
+            tracks = self._cached_tracks()
+            if isinstance(tracks, list) and any(
+                    isinstance(track, dict) and track.get('id') == track_id for track in tracks):
+                logger.info("Track %s already in Emy, skipping upload", track_id)
+                return True
+            
+            # Track metadata form fields
+            data = self._add_data_template.copy()
+            data.update({
+                'track.id': str(track_id),
+                'track.title': title,
+                'track.artist': artist,
+                'track.mediaType': media_type
+            })
             
-            # Upload file with metadata
+            # Upload file with metadata, streamed from the file object in one multipart body
+            # (see _match_audio_uncached for why this can't be an mmap)
             with open(audio_file, 'rb') as f:
-                files = {'file': (os.path.basename(audio_file), f, 'audio/wav')}
+                fields = list(data.items())
+                fields.append(('file', (os.path.basename(audio_file), f, 'audio/wav')))
+                encoder = MultipartEncoder(fields=fields)
                 
-                # Add track metadata as form fields
-                data = {
-                    'track.id': track_data['id'],
-                    'track.title': track_data['title'],
-                    'track.artist': track_data['artist'],
-                    'track.mediaType': track_data['mediaType'],
-                    'insertOriginalPoints': 'true'
-                }
-                
-                response = requests.post(
-                    f"{self.endpoint}/tracks",
-                    auth=self.auth,
-                    files=files,
-                    data=data,
-                    headers={'Accept': 'application/json'},
+                response = self.session.post(
+                    self._url_tracks,
+                    data=encoder,
+                    headers={'Content-Type': encoder.content_type},
                     timeout=30
                 )
             
             if response.status_code in [200, 201]:
-                logger.info(f"Successfully added track: {title}")
+                # The new track may change the answer for previously seen audio
+                self.clear_cache()
+                self.invalidate_tracks_cache()
+                logger.info("Successfully added track: %s", title)
                 return True
             else:
-                logger.error(f"Failed to add track: {response.status_code} - {response.text}")
+                logger.error("Failed to add track: %s - %s", response.status_code, response.text)
                 return False
                 
         except Exception as e:
-            logger.error(f"Error adding fingerprint: {e}")
+            logger.error("Error adding fingerprint: %s", e)
             return False
     
+    def add_fingerprints(self, tracks):
+        """
+        Insert several tracks, tracks is a list of add_fingerprint keyword dicts
+        Emy has no batch insert, the uploads run concurrently over the pooled session
+        """
+        return list(self._pool.map(lambda track: self.add_fingerprint(**track), tracks))
+    
     def get_matches(self, limit=50, since_days=1):
         """Retrieve registered matches from Emy"""
         try:
-            response = requests.get(
-                f"{self.endpoint}/matches",
-                auth=self.auth,
+            response = self.session.get(
+                self._url_matches,
                 params={'limit': limit, 'sinceDays': since_days},
-                headers={'Accept': 'application/json'},
                 timeout=self.timeout
             )
             
             if response.status_code == 200:
-                return response.json()
+                return orjson.loads(response.content)
             else:
-                logger.warning(f"Failed to get matches: {response.status_code}")
+                logger.warning("Failed to get matches: %s", response.status_code)
                 return None
                 
         except Exception as e:
-            logger.error(f"Error getting matches: {e}")
-            return None
\ No newline at end of file
+            logger.error("Error getting matches: %s", e)
+            return None
+
+class AsyncFingerprintClient:
+    """asyncio counterpart of FingerprintClient, overlapping queries share one connection pool"""
+    def __init__(self):
+        self.set_endpoint('http://soundfingerprinting:3340')
+        self.timeout = 10
+        # Created lazily inside the event loop that uses it
+        self._session = None
+    
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth('Admin', ''),
+                headers={'Accept': 'application/json'},
+                connector=aiohttp.TCPConnector(limit=20, keepalive_timeout=60)
+            )
+        return self._session
+    
+    def set_endpoint(self, endpoint):
+        self.endpoint = _api_base(endpoint)
+        self._url_query = self.endpoint + '/tracks/query'
+    
+    async def aclose(self):
+        """Release the pooled connections"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+    
+    async def match_audio(self, audio_file_path):
+        """Query Emy with an audio file to find matches"""
+        try:
+            if not os.path.exists(audio_file_path):
+                logger.error("Audio file not found: %s", audio_file_path)
+                return None
+            
+            async with aiofiles.open(audio_file_path, 'rb') as f:
+                blob = await f.read()
+            
+            return await self._query(blob, os.path.basename(audio_file_path))
+            
+        except Exception as e:
+            logger.error("Error querying audio: %s", e)
+            return None
+    
+    async def match_wav(self, payload):
+        """Query Emy with an in-memory WAV file"""
+        return await self._query(payload, 'query.wav')
+    
+    async def _query(self, blob, filename):
+        try:
+            data = aiohttp.FormData()
+            data.add_field('file', blob, filename=filename, content_type='audio/wav')
+            
+            async with self._get_session().post(
+                self._url_query,
+                data=data,
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            ) as response:
+                if response.status == 200:
+                    return _summarize_matches(orjson.loads(await response.read()))
+                logger.warning("Query failed: %s - %s", response.status, await response.text())
+                return None
+                
+        except TimeoutError:
+            logger.warning("Fingerprint query timed out")
+            return None
+        except Exception as e:
+            logger.error("Error querying audio: %s", e)
+            return None
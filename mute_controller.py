@@ -1,50 +1,148 @@
 import subprocess
 import platform
+import queue
+import threading
 import logging
 
+# In-process mixer APIs, each optional; without one the OS command is run instead
+try:
+    import pulsectl
+except ImportError:
+    pulsectl = None
+
+try:
+    import comtypes
+    from ctypes import POINTER, cast
+    from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
+except ImportError:
+    AudioUtilities = None
+
+try:
+    from Foundation import NSAppleScript
+except ImportError:
+    NSAppleScript = None
+
 logger = logging.getLogger(__name__)
 
+# (mute, unmute) command lines run when no mixer API is available
+SYSTEM_COMMANDS = {
+    'Linux': (['amixer', 'set', 'Master', 'mute'], ['amixer', 'set', 'Master', 'unmute']),
+    'Darwin': (['osascript', '-e', 'set volume output muted true'],
+               ['osascript', '-e', 'set volume output muted false']),
+    'Windows': (['nircmd.exe', 'mutesysvolume', '1'], ['nircmd.exe', 'mutesysvolume', '0']),
+}
+
 class MuteController:
     def __init__(self):
         self.system = platform.system()
         self.is_muted = False
+        # The platform never changes, pick its commands once
+        mute_argv, unmute_argv = SYSTEM_COMMANDS.get(self.system, (None, None))
+        self._argv = {True: mute_argv, False: unmute_argv}
+        # Single-slot, latest-wins hand-off to the worker that runs the OS command
+        self._cmd_q = queue.Queue(maxsize=1)
+        self._submit_lock = threading.Lock()
+        # Bumped on every submission, a failed command only reverts is_muted if it is still the latest
+        self._seq = 0
+        # set_mute(muted) on a persistent mixer handle, opened by the worker thread
+        self._backend = None
+        threading.Thread(target=self._worker, daemon=True).start()
     
     def mute(self):
         if self.is_muted:
             return
         
-        try:
-            if self.system == 'Linux':
-                subprocess.run(['amixer', 'set', 'Master', 'mute'], check=True)
-            elif self.system == 'Darwin':  # macOS
-                subprocess.run(['osascript', '-e', 'set volume output muted true'], check=True)
-            elif self.system == 'Windows':
-                subprocess.run(['nircmd.exe', 'mutesysvolume', '1'], check=True)
-            
-            self.is_muted = True
-            logger.info("Audio muted")
-        except Exception as e:
-            logger.error(f"Failed to mute: {e}")
+        self._submit(True)
     
     def unmute(self):
         if not self.is_muted:
             return
         
-        try:
-            if self.system == 'Linux':
-                subprocess.run(['amixer', 'set', 'Master', 'unmute'], check=True)
-            elif self.system == 'Darwin':  # macOS
-                subprocess.run(['osascript', '-e', 'set volume output muted false'], check=True)
-            elif self.system == 'Windows':
-                subprocess.run(['nircmd.exe', 'mutesysvolume', '0'], check=True)
-            
-            self.is_muted = False
-            logger.info("Audio unmuted")
-        except Exception as e:
-            logger.error(f"Failed to unmute: {e}")
+        self._submit(False)
     
     def toggle(self):
         if self.is_muted:
             self.unmute()
         else:
-            self.mute()
\ No newline at end of file
+            self.mute()
+    
+    def _submit(self, muted):
+        """Queue the mute state, replacing any command the worker hasn't picked up yet"""
+        with self._submit_lock:
+            self.is_muted = muted
+            self._seq += 1
+            try:
+                self._cmd_q.get_nowait()
+            except queue.Empty:
+                pass
+            self._cmd_q.put_nowait((self._seq, muted))
+    
+    def _open_backend(self):
+        """Bind once to the platform mixer API, None if it isn't available"""
+        try:
+            if self.system == 'Linux' and pulsectl is not None:
+                pulse = pulsectl.Pulse('commute')
+                default = pulse.server_info().default_sink_name
+                sink = next(s for s in pulse.sink_list() if s.name == default)
+                return lambda muted: pulse.sink_mute(sink.index, muted)
+            
+            if self.system == 'Darwin' and NSAppleScript is not None:
+                scripts = {}
+                for muted in (True, False):
+                    script = NSAppleScript.alloc().initWithSource_(
+                        f"set volume output muted {'true' if muted else 'false'}")
+                    script.compileAndReturnError_(None)
+                    scripts[muted] = script
+                
+                def set_mute(muted):
+                    _, error = scripts[muted].executeAndReturnError_(None)
+                    if error is not None:
+                        raise RuntimeError(error)
+                return set_mute
+            
+            if self.system == 'Windows' and AudioUtilities is not None:
+                # COM objects belong to the thread that created them
+                comtypes.CoInitialize()
+                interface = AudioUtilities.GetSpeakers().Activate(
+                    IAudioEndpointVolume._iid_, comtypes.CLSCTX_ALL, None)
+                volume = cast(interface, POINTER(IAudioEndpointVolume))
+                return lambda muted: volume.SetMute(1 if muted else 0, None)
+        except Exception as e:
+            logger.warning("Mixer API unavailable, using system commands: %s", e)
+        return None
+    
+    def _backend_set(self, muted):
+        """Set the mute state through the mixer handle, False if there is none or it failed"""
+        if self._backend is None:
+            return False
+        try:
+            self._backend(muted)
+            return True
+        except Exception as e:
+            # e.g. the sound server restarted, fall back to the system command from now on
+            logger.warning("Mixer API failed, using system commands: %s", e)
+            self._backend = None
+            return False
+    
+    def _worker(self):
+        self._backend = self._open_backend()
+        while True:
+            seq, muted = self._cmd_q.get()
+            if not self._set_system(muted):
+                with self._submit_lock:
+                    # Let the next call retry, unless a newer command already replaced this one
+                    if seq == self._seq:
+                        self.is_muted = not muted
+    
+    def _set_system(self, muted):
+        try:
+            if not self._backend_set(muted):
+                argv = self._argv[muted]
+                if argv:
+                    subprocess.run(argv, check=True)
+            
+            logger.info("Audio muted" if muted else "Audio unmuted")
+            return True
+        except Exception as e:
+            logger.error("Failed to %s: %s", 'mute' if muted else 'unmute', e)
+            return False
@@ -0,0 +1,103 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fingerprint_client import FingerprintClient
+
+class FakeEmy(BaseHTTPRequestHandler):
+    """Reads the whole request body and answers every query with no match"""
+    bodies = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.bodies.append((self.path, body))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'[]')
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def emy():
+    FakeEmy.bodies = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeEmy)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def client(emy):
+    client = FingerprintClient()
+    client.set_endpoint(f"http://127.0.0.1:{emy.server_port}")
+    yield client
+    client.close()
+
+def finishes(fn, *args, timeout=10):
+    """fn(*args), failing the test instead of hanging the run if it never returns"""
+    result = []
+    worker = threading.Thread(target=lambda: result.append(fn(*args)), daemon=True)
+    worker.start()
+    worker.join(timeout)
+    assert result, f"{fn.__name__} did not finish, the upload never reached EOF"
+    return result[0]
+
+def wav_file(path, size):
+    path.write_bytes(bytes(range(256)) * (size // 256) + b'\x00' * (size % 256))
+    return str(path)
+
+def test_match_audio_uploads_whole_file(client, tmp_path):
+    audio = wav_file(tmp_path / 'query.wav', 100260)
+
+    assert finishes(client.match_audio, audio) == {'is_match': False}
+
+    path, body = FakeEmy.bodies[0]
+    assert path == '/api/v1.1/tracks/query'
+    assert open(audio, 'rb').read() in body
+
+def test_add_fingerprint_uploads_fields_and_whole_file(client, tmp_path):
+    audio = wav_file(tmp_path / 'ad.wav', 100260)
+
+    assert finishes(client.add_fingerprint, audio, 'ad_1', 'Car Commercial') is True
+
+    path, body = FakeEmy.bodies[0]
+    assert path == '/api/v1.1/tracks'
+    assert b'name="track.id"\r\n\r\nad_1\r\n' in body
+    assert b'name="track.title"\r\n\r\nCar Commercial\r\n' in body
+    assert open(audio, 'rb').read() in body
+
+def test_match_audio_many_uploads_every_file(client, tmp_path):
+    audio = []
+    for i in range(4):
+        path = tmp_path / f'query{i}.wav'
+        # Distinct content, so each upload can only match its own file
+        path.write_bytes(bytes([i + 1]) * 50000)
+        audio.append(str(path))
+
+    assert finishes(client.match_audio_many, audio) == [{'is_match': False}] * 4
+
+    uploaded = [body for _, body in FakeEmy.bodies]
+    assert len(uploaded) == 4
+    for path in audio:
+        data = open(path, 'rb').read()
+        assert sum(data in body for body in uploaded) == 1
+
+def test_https_uses_the_pooled_adapter():
+    client = FingerprintClient()
+    adapter = client.session.get_adapter('https://emy.example/api/v1.1/tracks')
+    assert adapter is client.session.get_adapter('http://emy.example/api/v1.1/tracks')
+    assert adapter.max_retries.total == 2
+    client.close()
+
+def test_match_audio_rejects_empty_file(client, tmp_path, caplog):
+    audio = wav_file(tmp_path / 'empty.wav', 0)
+
+    assert client.match_audio(audio) is None
+
+    assert 'Audio file is empty' in caplog.text
+    assert FakeEmy.bodies == []
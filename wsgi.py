@@ -0,0 +1,10 @@
+"""
+Production entry point
+gunicorn -k gthread --threads 32 -w 1 -b 0.0.0.0:8080 wsgi:app
+"""
+import os
+
+from app import app
+
+os.makedirs('/recordings', exist_ok=True)
+os.makedirs('/data', exist_ok=True)